@@ -3,13 +3,14 @@ import shutil
 import json
 import os
 import sqlite3
+import time
 from pathlib import Path
-from flask import Flask, render_template, g, request, send_from_directory
-from livereload import Server
+from flask import Flask, render_template, g, request, send_from_directory, abort
 import zipfile
+import fnmatch
 
-from extract_html_images import extract_html_images
-from extract_pdf_images import extract_pdf_images
+from publication_cache import PublicationCache
+from extractors import get_extractor
 
 GALLERY_DATA_DIR = Path('./data')
 if not GALLERY_DATA_DIR.exists():
@@ -20,38 +21,141 @@ ZOTERO_DATA_DIR = Path('~/Zotero').expanduser().resolve()
 
 ZOTERO_DB_NAME = 'zotero.sqlite'
 BBT_DB_NAME = 'better-bibtex.sqlite'
-ZOTERO_SRC_DB = ZOTERO_DATA_DIR.joinpath(ZOTERO_DB_NAME)
-BBT_SRC_DB = ZOTERO_DATA_DIR.joinpath(BBT_DB_NAME)
-ZOTERO_GALLERY_DB = GALLERY_DATA_DIR.joinpath(ZOTERO_DB_NAME)
-BBT_GALLERY_DB = GALLERY_DATA_DIR.joinpath(BBT_DB_NAME)
 
 ZOTERO_GALLERY_COLLECTION_NAME = '_Gallery'
-GALLERY_DB = GALLERY_DATA_DIR.joinpath('gallery' + ZOTERO_GALLERY_COLLECTION_NAME + '.sqlite')
+# Every collection (and all of its sub-collections) shown in the gallery
+ZOTERO_GALLERY_COLLECTION_NAMES = [ZOTERO_GALLERY_COLLECTION_NAME]
 STORAGE = 'storage/'
 STORAGE_DB = 'storage:'
-STORAGE_DIR = ZOTERO_DATA_DIR.joinpath(STORAGE)
 PUBS_FOLDER = Path('./images')
 if not PUBS_FOLDER.exists():
     os.makedirs(PUBS_FOLDER)
 PUBS_FOLDER = PUBS_FOLDER.resolve()
 PREVIEW_INDEX_PACKED = -1
-
-GALLERY_ZIP = GALLERY_DATA_DIR.joinpath('gallery' + ZOTERO_GALLERY_COLLECTION_NAME + '.zip')
 SYNC_PUB_TAG = 'z_Gallery_Sync_Placeholder'
 
-EXTRACTORS = {
-    'application/pdf': extract_pdf_images,
-    'text/html': extract_html_images,
-}
+# Additional Zotero libraries (other users, group libraries...) served by the
+# same gallery, e.g.:
+# {
+#     "alice": {"zotero_dir": "/home/alice/Zotero", "collections": ["_Gallery"]}
+# }
+# Each library keeps its databases and images in data/<name>/ and is served
+# under /lib/<name>/
+LIBRARIES_CONFIG = GALLERY_DATA_DIR.joinpath('libraries.json')
+DEFAULT_LIBRARY_NAME = 'default'
+
+# Memory budget shared by the publication caches of every library
+PUBLICATION_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Seconds between checks of the publication folders for changed images
+PUBS_FOLDER_CHECK_INTERVAL = 5
+
+# Largest Hamming distance (out of 64 bits) between the perceptual hashes of
+# two images for them to count as similar
+SIMILAR_IMAGE_MAX_DISTANCE = 10
+
+# Static site export: publications per JSON page shard, and thumbnail width
+EXPORT_PAGE_SIZE = 100
+EXPORT_THUMBNAIL_WIDTH = 400
 
 FLASK_HOST = '127.0.0.1'
 FLASK_PORT = 5000
 FLASK_DEBUG = True
 
+class Library:
+    '''
+    A Zotero library served by the gallery: where its Zotero data lives, where
+    the gallery keeps its copies of the databases and the extracted images,
+    and which collections are shown.
+    '''
+    def __init__(self, name, zotero_data_dir, gallery_data_dir, pubs_folder, collection_names, gallery_name=ZOTERO_GALLERY_COLLECTION_NAME):
+        self.name = name
+        self.collection_names = list(collection_names)
+
+        self.zotero_data_dir = Path(zotero_data_dir).expanduser().resolve()
+        self.gallery_data_dir = Path(gallery_data_dir)
+        if not self.gallery_data_dir.exists():
+            os.makedirs(self.gallery_data_dir)
+        self.gallery_data_dir = self.gallery_data_dir.resolve()
+        self.pubs_folder = Path(pubs_folder)
+        if not self.pubs_folder.exists():
+            os.makedirs(self.pubs_folder)
+        self.pubs_folder = self.pubs_folder.resolve()
+
+        self.zotero_src_db = self.zotero_data_dir.joinpath(ZOTERO_DB_NAME)
+        self.bbt_src_db = self.zotero_data_dir.joinpath(BBT_DB_NAME)
+        self.zotero_gallery_db = self.gallery_data_dir.joinpath(ZOTERO_DB_NAME)
+        self.bbt_gallery_db = self.gallery_data_dir.joinpath(BBT_DB_NAME)
+        self.gallery_db = self.gallery_data_dir.joinpath('gallery' + gallery_name + '.sqlite')
+        self.gallery_zip = self.gallery_data_dir.joinpath('gallery' + gallery_name + '.zip')
+        self.storage_dir = self.zotero_data_dir.joinpath(STORAGE)
+
+        # (time checked, hash of the publication folder mtimes)
+        self._pub_folders_version = (None, None)
+
+    def cache_version(self):
+        '''
+        Modification times of everything a publication listing is built from,
+        so cached listings are dropped when another process (pull, extract,
+        unpack...) or a manual edit changes them. Each publication folder is
+        included, since adding or removing an image only changes the mtime of
+        its own folder, but those are only checked every
+        PUBS_FOLDER_CHECK_INTERVAL seconds.
+        '''
+        paths = [self.zotero_gallery_db, self.bbt_gallery_db, self.gallery_db, self.pubs_folder]
+        version = tuple(p.stat().st_mtime_ns if p.exists() else None for p in paths)
+        return version + (self.pub_folders_version(), )
+
+    def pub_folders_version(self):
+        checked, version = self._pub_folders_version
+        now = time.monotonic()
+        if checked is not None and now - checked < PUBS_FOLDER_CHECK_INTERVAL:
+            return version
+        version = None
+        if self.pubs_folder.exists():
+            with os.scandir(self.pubs_folder) as entries:
+                version = hash(tuple(sorted((e.name, e.stat().st_mtime_ns) for e in entries)))
+        self._pub_folders_version = (now, version)
+        return version
+
+    def clean_paths(self):
+        '''
+        Every file and folder the gallery created for this library. The default
+        library shares its data folder with libraries.json and the other
+        libraries' folders, so only its own files are listed.
+        '''
+        if self.gallery_data_dir != GALLERY_DATA_DIR:
+            paths = [self.gallery_data_dir]
+            if self.gallery_data_dir not in self.pubs_folder.parents:
+                paths.append(self.pubs_folder)
+            return paths
+        files = [self.zotero_gallery_db, self.bbt_gallery_db, self.gallery_db, self.gallery_zip]
+        return files + [Path(str(f) + '.bak') for f in files] + [self.pubs_folder]
+
+def load_libraries():
+    libraries = {
+        DEFAULT_LIBRARY_NAME: Library(DEFAULT_LIBRARY_NAME, ZOTERO_DATA_DIR, GALLERY_DATA_DIR, PUBS_FOLDER, ZOTERO_GALLERY_COLLECTION_NAMES),
+    }
+    if LIBRARIES_CONFIG.exists():
+        with open(LIBRARIES_CONFIG) as fin:
+            config = json.load(fin)
+        for name, library_config in config.items():
+            if name == DEFAULT_LIBRARY_NAME:
+                print('Warning: library name `{}` is reserved for the default library, ignoring it in {}'.format(name, LIBRARIES_CONFIG))
+                continue
+            library_dir = GALLERY_DATA_DIR.joinpath(name)
+            collection_names = library_config.get('collections', [ZOTERO_GALLERY_COLLECTION_NAME])
+            libraries[name] = Library(name, library_config['zotero_dir'], library_dir, library_dir.joinpath('images'), collection_names)
+    return libraries
+
+LIBRARIES = load_libraries()
+DEFAULT_LIBRARY = LIBRARIES[DEFAULT_LIBRARY_NAME]
+
+publication_cache = PublicationCache(PUBLICATION_CACHE_MAX_BYTES)
+
 # Flask web app
 app = Flask(__name__, static_folder='images')
 
-def pull(include_gallery_data=True):
+def pull(include_gallery_data=True, library=DEFAULT_LIBRARY):
     '''
     Pull (make a copy of) the Zotero databases so we can run the gallery at the
     same time as Zotero.
@@ -62,45 +166,45 @@ def pull(include_gallery_data=True):
     '''
     print('Pulling...')
     # make backups
-    zotero_bak = Path(str(ZOTERO_GALLERY_DB) + '.bak')
-    bbt_bak = Path(str(BBT_GALLERY_DB) + '.bak')
-    gallery_db_bak = Path(str(GALLERY_DB) + '.bak')
-    gallery_zip_bak = Path(str(GALLERY_ZIP) + '.bak')
-    if ZOTERO_GALLERY_DB.exists():
-        shutil.copyfile(ZOTERO_GALLERY_DB, zotero_bak)
-    if BBT_GALLERY_DB.exists():
-        shutil.copyfile(BBT_GALLERY_DB, bbt_bak)
-    if GALLERY_DB.exists():
-        shutil.copyfile(GALLERY_DB, gallery_db_bak)
-    if GALLERY_ZIP.exists() and include_gallery_data:
-        shutil.copyfile(GALLERY_ZIP, gallery_zip_bak)
+    zotero_bak = Path(str(library.zotero_gallery_db) + '.bak')
+    bbt_bak = Path(str(library.bbt_gallery_db) + '.bak')
+    gallery_db_bak = Path(str(library.gallery_db) + '.bak')
+    gallery_zip_bak = Path(str(library.gallery_zip) + '.bak')
+    if library.zotero_gallery_db.exists():
+        shutil.copyfile(library.zotero_gallery_db, zotero_bak)
+    if library.bbt_gallery_db.exists():
+        shutil.copyfile(library.bbt_gallery_db, bbt_bak)
+    if library.gallery_db.exists():
+        shutil.copyfile(library.gallery_db, gallery_db_bak)
+    if library.gallery_zip.exists() and include_gallery_data:
+        shutil.copyfile(library.gallery_zip, gallery_zip_bak)
     print('    - made backups')
 
     # then, make a copy of the Zotero databases in local data folder
-    shutil.copyfile(ZOTERO_SRC_DB, ZOTERO_GALLERY_DB)
-    shutil.copyfile(BBT_SRC_DB, BBT_GALLERY_DB)
+    shutil.copyfile(library.zotero_src_db, library.zotero_gallery_db)
+    shutil.copyfile(library.bbt_src_db, library.bbt_gallery_db)
     print('    - copied zotero database and better bibtex database')
 
     # copy gallery database and gallery images
     if include_gallery_data:
-        sync_paths = get_gallery_sync_attachment_paths()
+        sync_paths = get_gallery_sync_attachment_paths(library)
         if sync_paths is not None:
-            if sync_paths[GALLERY_DB.name] is not None:
-                shutil.copyfile(sync_paths[GALLERY_DB.name], GALLERY_DB)
+            if sync_paths[library.gallery_db.name] is not None:
+                shutil.copyfile(sync_paths[library.gallery_db.name], library.gallery_db)
                 print('    - copied gallery database')
-            if sync_paths[GALLERY_ZIP.name] is not None:
-                shutil.copyfile(sync_paths[GALLERY_ZIP.name], GALLERY_ZIP)
+            if sync_paths[library.gallery_zip.name] is not None:
+                shutil.copyfile(sync_paths[library.gallery_zip.name], library.gallery_zip)
                 print('    - copied image archive')
 
             # extract/unpack gallery image archive
-            unpack()
+            unpack(library)
             print('    - extracted gallery archive')
         else:
             print('    - failed to copy gallery database and archive')
             print('    - failed to extract gallery archive')
 
 
-def push():
+def push(library=DEFAULT_LIBRARY):
     '''
     Push (copy gallery.sqlite and gallery.zip to) zotero publication entry that
     has an attachment storing these databases for easy syncing across devices.
@@ -110,31 +214,31 @@ def push():
     Make a backup in case something goes wrong.
     '''
     # make backups
-    zotero_bak = Path(str(ZOTERO_SRC_DB) + '.gallery.bak')
-    bbt_bak = Path(str(BBT_SRC_DB) + '.gallery.bak')
-    if ZOTERO_SRC_DB.exists():
-        shutil.copyfile(ZOTERO_SRC_DB, zotero_bak)
-    if BBT_SRC_DB.exists():
-        shutil.copyfile(BBT_SRC_DB, bbt_bak)
-
-    pack()
+    zotero_bak = Path(str(library.zotero_src_db) + '.gallery.bak')
+    bbt_bak = Path(str(library.bbt_src_db) + '.gallery.bak')
+    if library.zotero_src_db.exists():
+        shutil.copyfile(library.zotero_src_db, zotero_bak)
+    if library.bbt_src_db.exists():
+        shutil.copyfile(library.bbt_src_db, bbt_bak)
+
+    pack(library)
     print('    - packed gallery images into archive')
 
-    sync_paths = get_gallery_sync_attachment_paths()
+    sync_paths = get_gallery_sync_attachment_paths(library)
     if sync_paths is not None:
-        shutil.copyfile(GALLERY_DB, sync_paths[GALLERY_DB.name])
-        shutil.copyfile(GALLERY_ZIP, sync_paths[GALLERY_ZIP.name])
+        shutil.copyfile(library.gallery_db, sync_paths[library.gallery_db.name])
+        shutil.copyfile(library.gallery_zip, sync_paths[library.gallery_zip.name])
         print('    - copied gallery database and archive')
     else:
         print('    - failed copy database and archive')
 
-def get_gallery_sync_attachment_paths():
+def get_gallery_sync_attachment_paths(library=DEFAULT_LIBRARY):
     # pack stuff up
     with app.app_context():
-        cur_zotero = get_zotero_db().cursor()
+        cur_zotero = get_zotero_db(library).cursor()
 
         # Get the publication gallery stuff is stored in
-        all_tags = get_tags()
+        all_tags = get_tags(library)
         try:
             tag_id, _sync_tag = next(filter(lambda p: p[1] == SYNC_PUB_TAG, all_tags.items()))
         except StopIteration:
@@ -144,7 +248,7 @@ def get_gallery_sync_attachment_paths():
         (item_id, ) = pub_id_res.fetchone()
 
         # Get attachments and verify they're all present
-        expected_attachment_names = [GALLERY_DB.name, GALLERY_ZIP.name]
+        expected_attachment_names = [library.gallery_db.name, library.gallery_zip.name]
         attachs_res = cur_zotero.execute(f'SELECT itemID, contentType, path FROM itemAttachments WHERE parentItemID = {item_id}')
         actual_attachments = {n: None for n in expected_attachment_names}
         for attach_id, content_type, path in attachs_res.fetchall():
@@ -152,12 +256,12 @@ def get_gallery_sync_attachment_paths():
             if actual_filename in expected_attachment_names:
                 # lookup canonical attachment ID in main `items` table
                 attachment_key = cur_zotero.execute(f'SELECT key FROM items WHERE itemID = {attach_id}').fetchone()[0]
-                actual_attachments[actual_filename] = get_attachment_path(attachment_key, actual_filename)
+                actual_attachments[actual_filename] = get_attachment_path(attachment_key, actual_filename, library)
             else:
                 print('Warning: unexpected attachment ', actual_filename)
         return actual_attachments
 
-def pack():
+def pack(library=DEFAULT_LIBRARY):
     '''
     Reduce the number of extracted images in each publication directory to a
     single one and update the zotero gallery database accordingly (specify -1
@@ -170,25 +274,26 @@ def pack():
     '''
     print('Packing publication images...')
     # make backups
-    gallery_db_bak = Path(str(GALLERY_DB) + '.bak')
-    gallery_zip_bak = Path(str(GALLERY_ZIP) + '.bak')
-    if GALLERY_DB.exists():
-        shutil.copyfile(GALLERY_DB, gallery_db_bak)
-    if GALLERY_ZIP.exists():
-        shutil.copyfile(GALLERY_ZIP, gallery_zip_bak)
+    gallery_db_bak = Path(str(library.gallery_db) + '.bak')
+    gallery_zip_bak = Path(str(library.gallery_zip) + '.bak')
+    if library.gallery_db.exists():
+        shutil.copyfile(library.gallery_db, gallery_db_bak)
+    if library.gallery_zip.exists():
+        shutil.copyfile(library.gallery_zip, gallery_zip_bak)
     print('    - made backups')
 
     with app.app_context():
-        con_gallery = get_gallery_db()
+        con_gallery = get_gallery_db(library)
         cur_gallery = con_gallery.cursor()
 
         # get rid of superfluous publication images
         imgs_removed = 0
-        for pub_key in os.listdir(PUBS_FOLDER):
-            pub_path = PUBS_FOLDER.joinpath(pub_key)
+        packed_keys = []
+        for pub_key in os.listdir(library.pubs_folder):
+            pub_path = library.pubs_folder.joinpath(pub_key)
 
             # find actual image index and get nth image
-            res = cur_gallery.execute(f'SELECT previewImageIndex FROM gallery WHERE itemBibTexKey = "{pub_key}"')
+            res = cur_gallery.execute('SELECT previewImageIndex FROM gallery WHERE itemBibTexKey = ?', (pub_key, ))
             try:
                 (img_index, ) = res.fetchone()
             except TypeError:
@@ -200,24 +305,29 @@ def pack():
                 continue
 
             all_imgs = list(sorted(os.listdir(pub_path)))
+            pub_imgs_removed = 0
             for i, img in enumerate(all_imgs):
                 if i != img_index:
                     img_path = pub_path.joinpath(img)
                     os.unlink(img_path)
-                    cur_gallery.execute(f'UPDATE gallery SET previewImageIndex = {PREVIEW_INDEX_PACKED} WHERE itemBibTexKey = "{pub_key}"')
-                    imgs_removed += 1
-
-        con_gallery.commit()
+                    pub_imgs_removed += 1
+            if pub_imgs_removed > 0:
+                packed_keys.append((PREVIEW_INDEX_PACKED, pub_key))
+                imgs_removed += pub_imgs_removed
+
+        # mark every packed publication in one transaction
+        with con_gallery:
+            cur_gallery.executemany('UPDATE gallery SET previewImageIndex = ? WHERE itemBibTexKey = ?', packed_keys)
     print(f'    - removed {imgs_removed} images')
 
     # rewrite zip file (copy all folders/single images in)
-    z = zipfile.ZipFile(GALLERY_ZIP, 'w')
+    z = zipfile.ZipFile(library.gallery_zip, 'w')
     print('    - generating zip file')
-    all_pubs = os.listdir(PUBS_FOLDER)
+    all_pubs = os.listdir(library.pubs_folder)
     for i, pub_key in enumerate(all_pubs):
         if i % max(1, len(all_pubs) // 10) == 0:
             print('        ({:.0%} done)'.format(i / len(all_pubs)))
-        pub_path = PUBS_FOLDER.joinpath(pub_key)
+        pub_path = library.pubs_folder.joinpath(pub_key)
 
         all_imgs = list(sorted(os.listdir(pub_path)))
         if len(all_imgs) > 1:
@@ -230,62 +340,225 @@ def pack():
             print(f'Warning: pub {pub_key} was improperly packed (has no images). Skipping.')
 
 
-def unpack():
+def unpack(library=DEFAULT_LIBRARY):
     '''
     Unpack a gallery.zip file into the images directory for publications
     '''
     print('Unpacking...')
     # unpack gallery.zip file into images publications folder
-    z = zipfile.ZipFile(GALLERY_ZIP, 'r')
+    z = zipfile.ZipFile(library.gallery_zip, 'r')
     names = set(z.namelist())
-    existing = {Path(pub_key).joinpath(img).as_posix() for pub_key in os.listdir(PUBS_FOLDER) for img in os.listdir(PUBS_FOLDER.joinpath(pub_key))}
+    existing = {Path(pub_key).joinpath(img).as_posix() for pub_key in os.listdir(library.pubs_folder) for img in os.listdir(library.pubs_folder.joinpath(pub_key))}
     difference = names - existing
 
-    z.extractall(PUBS_FOLDER)
+    z.extractall(library.pubs_folder)
     print(f'    - extracted {len(names)} files from gallery ({len(difference)} new)')
 
-def extract_images():
+def get_collection_closure(cur_zotero, collection_names):
+    '''
+    Find every Zotero collection named in `collection_names` along with all of
+    its nested sub-collections.
+
+    Returns a dict of collectionID: (key, name, parentCollectionID) for every
+    collection found, and the closure of the collection hierarchy as a list of
+    (ancestorID, descendantID, depth) tuples (every collection is also its own
+    ancestor at depth 0).
+    '''
+    all_collections = {}
+    children = {}
+    for collection_id, key, name, parent_id in cur_zotero.execute('SELECT collectionID, key, collectionName, parentCollectionID FROM collections').fetchall():
+        all_collections[collection_id] = (key, name, parent_id)
+        children.setdefault(parent_id, []).append(collection_id)
+
+    roots = [cid for cid, (_key, name, _parent) in all_collections.items() if name in collection_names]
+    found_names = {all_collections[cid][1] for cid in roots}
+    for name in collection_names:
+        if name not in found_names:
+            print('Warning: collection `{}` not found in Zotero database'.format(name))
+
+    # walk down from the requested collections to find every sub-collection
+    collections = {}
+    stack = list(roots)
+    while len(stack) > 0:
+        collection_id = stack.pop()
+        if collection_id in collections:
+            continue
+        collections[collection_id] = all_collections[collection_id]
+        stack.extend(children.get(collection_id, []))
+
+    # then walk up from each one to find its ancestors (within the gallery)
+    closure = []
+    for collection_id in collections:
+        ancestor_id = collection_id
+        depth = 0
+        while ancestor_id in collections:
+            closure.append((ancestor_id, collection_id, depth))
+            ancestor_id = collections[ancestor_id][2]
+            depth += 1
+    return collections, closure
+
+def update_gallery_collections(cur_zotero, con_gallery, item_key_to_citekey, collection_names, extract_collection_names=None):
+    '''
+    Precompute the collection hierarchy and the (recursive) collection
+    membership of every gallery publication into the gallery database, so the
+    gallery can be filtered by collection without recursive queries.
+
+    Zotero IDs aren't consistent between machines, so collections are stored by
+    their Zotero key and publications by their bibtex key.
+
+    Returns the (itemID, key) of every publication in the collections named in
+    `extract_collection_names` (default: all of `collection_names`) and their
+    sub-collections.
+    '''
+    collections, closure = get_collection_closure(cur_zotero, collection_names)
+    ancestors = {}
+    for ancestor_id, descendant_id, _depth in closure:
+        ancestors.setdefault(descendant_id, []).append(ancestor_id)
+
+    if extract_collection_names is None:
+        extract_collection_names = collection_names
+    extract_collection_ids = {cid for cid, (_key, name, _parent) in collections.items() if name in extract_collection_names}
+
+    gallery_pubs = {}
+    membership = set()
+    collection_items = cur_zotero.execute('''
+        SELECT collectionItems.collectionID, items.itemID, items.key FROM collectionItems
+            INNER JOIN items ON items.itemID = collectionItems.itemID
+    ''')
+    for collection_id, item_id, item_key in collection_items.fetchall():
+        if collection_id not in collections or item_key not in item_key_to_citekey:
+            continue
+        if not extract_collection_ids.isdisjoint(ancestors[collection_id]):
+            gallery_pubs[item_id] = item_key
+        for ancestor_id in ancestors[collection_id]:
+            membership.add((collections[ancestor_id][0], item_key_to_citekey[item_key]))
+
+    cur_gallery = con_gallery.cursor()
+    with con_gallery:
+        cur_gallery.execute('DELETE FROM galleryCollections')
+        cur_gallery.execute('DELETE FROM galleryCollectionClosure')
+        cur_gallery.execute('DELETE FROM galleryCollectionMembership')
+        cur_gallery.executemany(
+            'INSERT INTO galleryCollections (collectionKey, collectionName, parentCollectionKey) VALUES (?, ?, ?);',
+            [(key, name, collections[parent_id][0] if parent_id in collections else None) for key, name, parent_id in collections.values()]
+        )
+        cur_gallery.executemany(
+            'INSERT INTO galleryCollectionClosure (ancestorKey, descendantKey, depth) VALUES (?, ?, ?);',
+            [(collections[ancestor_id][0], collections[descendant_id][0], depth) for ancestor_id, descendant_id, depth in closure]
+        )
+        cur_gallery.executemany('INSERT INTO galleryCollectionMembership (collectionKey, itemBibTexKey) VALUES (?, ?);', sorted(membership))
+    print('Found {} gallery collections ({} publications)'.format(len(collections), len(gallery_pubs)))
+
+    return sorted(gallery_pubs.items())
+
+def create_gallery_tables(cur_gallery):
+    # The zotero_id is not consistent between machines, so use bibtex key to
+    # identify publications instead
+    cur_gallery.execute('CREATE TABLE IF NOT EXISTS gallery (itemBibTexKey TEXT PRIMARY KEY NOT NULL, previewImageIndex INT DEFAULT 0);')
+    # Collection hierarchy (closure table) and recursive publication membership
+    cur_gallery.execute('CREATE TABLE IF NOT EXISTS galleryCollections (collectionKey TEXT PRIMARY KEY NOT NULL, collectionName TEXT NOT NULL, parentCollectionKey TEXT);')
+    cur_gallery.execute('CREATE TABLE IF NOT EXISTS galleryCollectionClosure (ancestorKey TEXT NOT NULL, descendantKey TEXT NOT NULL, depth INT NOT NULL, PRIMARY KEY (ancestorKey, descendantKey));')
+    cur_gallery.execute('CREATE TABLE IF NOT EXISTS galleryCollectionMembership (collectionKey TEXT NOT NULL, itemBibTexKey TEXT NOT NULL, PRIMARY KEY (collectionKey, itemBibTexKey));')
+    cur_gallery.execute('CREATE INDEX IF NOT EXISTS galleryCollectionMembershipItem ON galleryCollectionMembership (itemBibTexKey);')
+    # Perceptual hash of every extracted image (kept when images are packed)
+    cur_gallery.execute('CREATE TABLE IF NOT EXISTS imageHashes (itemBibTexKey TEXT NOT NULL, imageName TEXT NOT NULL, hash INTEGER NOT NULL, PRIMARY KEY (itemBibTexKey, imageName));')
+
+def hash_publication_images(pub_keys, library=DEFAULT_LIBRARY, skip=frozenset()):
+    '''
+    Compute the perceptual hash of every extracted image of the publications in
+    `pub_keys` (except the (bibtex key, image name) pairs in `skip`).
+
+    Returns a list of (bibtex key, image name, hash) for every image that could
+    be decoded.
+    '''
+    # only needed for hashing, so don't import NumPy at startup
+    from image_hash import hash_images
+
+    images = []
+    for pub_key in pub_keys:
+        pub_path = library.pubs_folder.joinpath(pub_key)
+        if not pub_path.exists():
+            continue
+        images.extend((pub_key, img) for img in sorted(os.listdir(pub_path)) if (pub_key, img) not in skip)
+    hashes = hash_images([library.pubs_folder.joinpath(pub_key, img) for pub_key, img in images])
+    return [(pub_key, img, h) for (pub_key, img), h in zip(images, hashes) if h is not None]
+
+def hash_gallery_images(library=DEFAULT_LIBRARY):
+    '''
+    Compute the perceptual hash of every extracted image that doesn't have one
+    yet (e.g. extracted before hashes were computed during `extract`)
+    '''
+    print('Hashing images...')
+    with app.app_context():
+        con_gallery = get_gallery_db(library)
+        cur_gallery = con_gallery.cursor()
+        create_gallery_tables(cur_gallery)
+        existing = set(cur_gallery.execute('SELECT itemBibTexKey, imageName FROM imageHashes').fetchall())
+        rows = hash_publication_images(os.listdir(library.pubs_folder), library, existing)
+        with con_gallery:
+            cur_gallery.executemany('INSERT OR REPLACE INTO imageHashes (itemBibTexKey, imageName, hash) VALUES (?, ?, ?);', rows)
+    print(f'    - hashed {len(rows)} new images ({len(existing)} already hashed)')
+
+def extract_images(only_keys=None, collection_names=None, library=DEFAULT_LIBRARY):
     '''
     Extract all images from every new publication in the Zotero database and
     place all images in the images/* folder.
+
+    Publications are gathered from every collection in `collection_names`
+    (default: the library's gallery collections) and all of their
+    sub-collections. If `only_keys` is given, only publications whose bibtex
+    key is in it are considered.
+
+    The collection hierarchy shown in the gallery is rebuilt from the library's
+    gallery collections along with `collection_names`, so extracting from other
+    collections doesn't drop the configured ones.
     '''
+    if collection_names is None:
+        collection_names = library.collection_names
+    hierarchy_names = library.collection_names + [name for name in collection_names if name not in library.collection_names]
+
     # if main zotero database doesn't exist, pull from the zotero directory
-    if not ZOTERO_GALLERY_DB.exists() or not BBT_GALLERY_DB.exists():
-        pull(False)
+    if not library.zotero_gallery_db.exists() or not library.bbt_gallery_db.exists():
+        pull(False, library)
 
     # Pretend to be a Flask app
     with app.app_context():
-        # Set up Better BibTeX
-        bibtex = get_bbt_json()
+        # Set up Better BibTeX (zotero item key -> bibtex key)
+        bibtex = get_bbt_json(library)
+        item_key_to_citekey = {e['itemKey']: e['citekey'] for e in bibtex}
 
         # main zotero cursor
-        con_zotero = get_zotero_db()
+        con_zotero = get_zotero_db(library)
         cur_zotero = con_zotero.cursor()
 
-        # Connect to gallery and set up `gallery` table if not done already
-        # The zotero_id is not consistent between machines, so use bibtex key to
-        # identify publications instead
-        con_gallery = get_gallery_db()
+        # Connect to gallery and set up tables if not done already
+        con_gallery = get_gallery_db(library)
         cur_gallery = con_gallery.cursor()
-        try:
-            cur_gallery.execute('CREATE TABLE gallery (itemBibTexKey TEXT PRIMARY KEY NOT NULL, previewImageIndex INT DEFAULT 0);')
-        except sqlite3.OperationalError:
-            pass
-
-        # find gallery collection in zotero and get all publications in it
-        gallery_id = cur_zotero.execute(f'SELECT collectionID FROM collections WHERE collectionName = "{ZOTERO_GALLERY_COLLECTION_NAME}"').fetchone()[0]
-        # get all publications in gallery collection
-        gallery_pub_ids = tuple(map(lambda i: i[0], cur_zotero.execute(f'SELECT itemID FROM collectionItems WHERE collectionID = "{gallery_id}"').fetchall()))
-        gallery_pubs = cur_zotero.execute(f'SELECT itemID, key FROM items WHERE itemID IN {gallery_pub_ids}').fetchall()
-
-        new_pubs = 0
-        for i, (item_id, item_key) in enumerate(gallery_pubs):
-            bbt_key = next(filter(lambda e: e['itemKey'] == item_key, bibtex))['citekey']
-            attachments = cur_zotero.execute(f'SELECT itemID, contentType, path FROM itemAttachments WHERE parentItemID = {item_id}')
+        create_gallery_tables(cur_gallery)
+
+        # find gallery collections in zotero and get all publications in them
+        gallery_pubs = update_gallery_collections(cur_zotero, con_gallery, item_key_to_citekey, hierarchy_names, collection_names)
+        if only_keys is not None:
+            only_keys = set(only_keys)
+            gallery_pubs = [(item_id, item_key) for item_id, item_key in gallery_pubs if item_key_to_citekey[item_key] in only_keys]
+
+        # Create db entries in one transaction before extracting anything, so
+        # every publication folder has an entry even if an extractor fails
+        pub_attachments = []
+        for item_id, item_key in gallery_pubs:
+            attachments = cur_zotero.execute('SELECT itemID, contentType, path FROM itemAttachments WHERE parentItemID = ?', (item_id, ))
             attachments_list = sorted(attachments.fetchall(), key=lambda c: c[1])
+            pub_attachments.append((item_key_to_citekey[item_key], attachments_list))
+        with con_gallery:
+            before = con_gallery.total_changes
+            cur_gallery.executemany('INSERT OR IGNORE INTO gallery (itemBibTexKey) VALUES (?);', [(bbt_key, ) for bbt_key, attachments_list in pub_attachments if len(attachments_list) > 0])
+            print('Inserted', con_gallery.total_changes - before, 'keys into gallery database')
 
+        new_pubs = 0
+        new_pub_keys = []
+        for i, (bbt_key, attachments_list) in enumerate(pub_attachments):
             # output path
-            image_path = PUBS_FOLDER.joinpath(bbt_key)
+            image_path = library.pubs_folder.joinpath(bbt_key)
             # check if publication output folder exists
             new_pub = False
             if not image_path.exists():
@@ -295,55 +568,58 @@ def extract_images():
 
             for attachment_id, content_type, attachment_file in attachments_list:
                 # lookup canonical attachment ID in main `items` table
-                attachment_key = cur_zotero.execute(f'SELECT key FROM items WHERE itemID = {attachment_id}').fetchone()[0]
+                attachment_key = cur_zotero.execute('SELECT key FROM items WHERE itemID = ?', (attachment_id, )).fetchone()[0]
                 # input path
-                attachment_path = get_attachment_path(attachment_key, attachment_file)
-                # Create db entry
-                try:
-                    cur_gallery.execute(f'INSERT INTO gallery (itemBibTexKey) VALUES ("{bbt_key}");')
-                    con_gallery.commit()
-                    print('Inserted key', bbt_key, 'into gallery database, zotero id', item_id)
-                except sqlite3.IntegrityError:
-                    pass
+                attachment_path = get_attachment_path(attachment_key, attachment_file, library)
 
                 # extract images from each publication based on its type
                 if new_pub:
                     # create folder to store images
                     if not image_path.exists():
                         os.makedirs(image_path)
-                    try:
-                        EXTRACTORS[content_type](image_path, attachment_path)
-                    except KeyError:
+                    extractor = get_extractor(content_type)
+                    if extractor is not None:
+                        extractor(image_path, attachment_path)
+                    else:
                         print('Extractor not found for type', content_type)
+            if new_pub:
+                new_pub_keys.append(bbt_key)
+
+        new_hashes = hash_publication_images(new_pub_keys, library)
+
+        with con_gallery:
+            cur_gallery.executemany('INSERT OR REPLACE INTO imageHashes (itemBibTexKey, imageName, hash) VALUES (?, ?, ?);', new_hashes)
+            print('Hashed', len(new_hashes), 'new images')
 
         print('Finished extracting images ({} new publications found)'.format(new_pubs))
         con_gallery.close()
 
 # Database functions (internal gallery, zotero, and better bibtex)
-# Gallery database for storing the gallery items
-def get_gallery_db():
-    db = getattr(g, 'gallery_db', None)
+# Connections are kept per library for the lifetime of the app context
+def get_db(db_name, library, connect):
+    dbs = getattr(g, 'dbs', None)
+    if dbs is None:
+        dbs = g.dbs = {}
+    db = dbs.get((db_name, library.name))
     if db is None:
-        g.gallery_db = sqlite3.connect(GALLERY_DB)
-    return g.gallery_db
+        db = dbs[(db_name, library.name)] = connect()
+    return db
+
+# Gallery database for storing the gallery items
+def get_gallery_db(library=DEFAULT_LIBRARY):
+    return get_db('gallery_db', library, lambda: sqlite3.connect(library.gallery_db))
 
 # Main Zotero database
-def get_zotero_db():
-    db = getattr(g, 'zotero_db', None)
-    if db is None:
-        g.zotero_db = sqlite3.connect('file:' + str(ZOTERO_GALLERY_DB) + '?mode=ro', uri=True)
-    return g.zotero_db
+def get_zotero_db(library=DEFAULT_LIBRARY):
+    return get_db('zotero_db', library, lambda: sqlite3.connect('file:' + str(library.zotero_gallery_db) + '?mode=ro', uri=True))
 
 # Better BibTeX database
-def get_bbt_db():
-    db = getattr(g, 'bbt_db', None)
-    if db is None:
-        g.bbt_db = sqlite3.connect('file:' + str(BBT_GALLERY_DB) + '?mode=ro', uri=True)
-    return g.bbt_db
+def get_bbt_db(library=DEFAULT_LIBRARY):
+    return get_db('bbt_db', library, lambda: sqlite3.connect('file:' + str(library.bbt_gallery_db) + '?mode=ro', uri=True))
 
-def get_bbt_json():
+def get_bbt_json(library=DEFAULT_LIBRARY):
     # better bibtex just shoves stuff in JSON...
-    con_bbt = get_bbt_db()
+    con_bbt = get_bbt_db(library)
     cur_bbt = con_bbt.cursor()
     better_bibtex = cur_bbt.execute('SELECT * FROM "better-bibtex" WHERE name = "better-bibtex.citekey"')
     name, json_bibtex = better_bibtex.fetchone()
@@ -354,18 +630,16 @@ def get_bbt_json():
 def close_connection(exception):
     if exception is not None:
         print(exception)
-    for db_name in ['gallery_db', 'zotero_db', 'bbt_db']:
-        db = getattr(g, db_name, None)
-        if db is not None:
-            db.close()
+    for db in getattr(g, 'dbs', {}).values():
+        db.close()
 
 # Construct the path of a Zotero attachment
-def get_attachment_path(attachment_key, attachment_file):
-    return STORAGE_DIR.joinpath(attachment_key).joinpath(str(attachment_file).replace(STORAGE_DB, ''))
+def get_attachment_path(attachment_key, attachment_file, library=DEFAULT_LIBRARY):
+    return library.storage_dir.joinpath(attachment_key).joinpath(str(attachment_file).replace(STORAGE_DB, ''))
 
 # Get key:value pairs of tagID:tag
-def get_tags():
-    cur_zotero = get_zotero_db().cursor()
+def get_tags(library=DEFAULT_LIBRARY):
+    cur_zotero = get_zotero_db(library).cursor()
 
     # Get tag list for helpfulness later
     tags_res = cur_zotero.execute('SELECT * FROM tags')
@@ -383,18 +657,32 @@ def get_tags():
 #       - title: str -- full title of publication
 #       - authors: list<str> -- all authors in publication
 #       - date: <str> -- date of publication (usually just year...)
-def get_publications():
+# If `collection_key` is given, only publications in that collection (or any of
+# its sub-collections) are included.
+# Listings are cached in memory until the library's databases or images change.
+def get_publications(collection_key=None, library=DEFAULT_LIBRARY):
+    version = library.cache_version()
+    publications = publication_cache.get(library.name, collection_key, version)
+    if publications is None:
+        publications = load_publications(collection_key, library)
+        publication_cache.put(library.name, collection_key, version, publications)
+    return publications
+
+def load_publications(collection_key, library):
     # Set up databases
-    cur_gallery = get_gallery_db().cursor()
-    cur_zotero = get_zotero_db().cursor()
-    bibtex = get_bbt_json()
+    cur_gallery = get_gallery_db(library).cursor()
+    cur_zotero = get_zotero_db(library).cursor()
+    bibtex = get_bbt_json(library)
 
     # Get tag list and field list for decoding tagIDs/fieldIDs later
-    tags = get_tags()
+    tags = get_tags(library)
     fields_res = cur_zotero.execute('SELECT fieldID, fieldName FROM fields')
     fields = dict(fields_res.fetchall())
 
-    pub_keys = os.listdir(PUBS_FOLDER)
+    pub_keys = os.listdir(library.pubs_folder)
+    if collection_key is not None:
+        members = get_collection_members(collection_key, library)
+        pub_keys = [k for k in pub_keys if k in members]
     publications = {}
     for pub_key in pub_keys:
         pub_data = {}
@@ -415,11 +703,11 @@ def get_publications():
         pub_data['zoteroItemID'] = zotero_id
         pub_data['previewImageIndex'] = preview_index
 
-        # Get `images` list
-        pub_folder = PUBS_FOLDER.joinpath(pub_key).relative_to(PUBS_FOLDER.parent)
+        # Get `images` list (relative to the library's gallery page)
+        pub_folder = library.pubs_folder.joinpath(pub_key)
         img_list = []
         for img in sorted(os.listdir(pub_folder)):
-            img_list.append(pub_folder.joinpath(img).as_posix())
+            img_list.append('images/' + pub_key + '/' + img)
         pub_data['images'] = img_list
 
         # Look into zotero db for tag
@@ -454,55 +742,246 @@ def get_publications():
         publications[pub_key] = pub_data
     return publications
 
-def get_img_preview_indices():
-    pub_keys = get_gallery_db().cursor().execute('SELECT itemBibTexKey, previewImageIndex FROM gallery')
+# Get all bibtex keys in a collection (and its sub-collections), precomputed
+# during `extract`
+def get_collection_members(collection_key, library=DEFAULT_LIBRARY):
+    cur_gallery = get_gallery_db(library).cursor()
+    try:
+        members = cur_gallery.execute('SELECT itemBibTexKey FROM galleryCollectionMembership WHERE collectionKey = ?', (collection_key, ))
+        return {k for (k, ) in members.fetchall()}
+    except sqlite3.OperationalError:
+        return set()
+
+# Get the gallery collection hierarchy, precomputed during `extract`
+# - collection key (zotero)
+#   - name: str -- name of the collection
+#   - parent: str -- key of the parent collection, null if it's a top-level gallery collection
+#   - count: int -- number of publications in the collection and its sub-collections
+def get_gallery_collections(library=DEFAULT_LIBRARY):
+    cur_gallery = get_gallery_db(library).cursor()
+    try:
+        collections_res = cur_gallery.execute('''
+            SELECT galleryCollections.collectionKey, collectionName, parentCollectionKey, COUNT(itemBibTexKey) FROM galleryCollections
+                LEFT JOIN galleryCollectionMembership ON galleryCollectionMembership.collectionKey = galleryCollections.collectionKey
+                GROUP BY galleryCollections.collectionKey
+        ''')
+    except sqlite3.OperationalError:
+        return {}
+    collections = {}
+    for key, name, parent_key, count in collections_res.fetchall():
+        collections[key] = {'name': name, 'parent': parent_key, 'count': count}
+    return collections
+
+# Perceptual hash index of every image in the gallery, rebuilt when the gallery
+# database changes
+image_hash_indices = {}
+
+def get_image_hash_index(library=DEFAULT_LIBRARY):
+    # only needed for similarity queries, so don't import NumPy at startup
+    from image_hash import ImageHashIndex
+
+    # nothing extracted yet
+    if not library.gallery_db.exists():
+        return ImageHashIndex([])
+    version = library.gallery_db.stat().st_mtime_ns
+    cached = image_hash_indices.get(library.name)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    try:
+        rows = get_gallery_db(library).cursor().execute('SELECT itemBibTexKey, hash FROM imageHashes').fetchall()
+    except sqlite3.OperationalError:
+        rows = []
+    index = ImageHashIndex(rows)
+    image_hash_indices[library.name] = (version, index)
+    return index
+
+# Get publications with figures similar to `pub_key`'s, most similar first
+# - key: str -- publication citation key (better bibtex)
+# - distance: int -- smallest Hamming distance between the two publications' image hashes
+# - matches: int -- number of `pub_key`'s images with a similar image in this publication
+def get_similar_publications(pub_key, max_distance=SIMILAR_IMAGE_MAX_DISTANCE, limit=None, library=DEFAULT_LIBRARY):
+    similar = get_image_hash_index(library).similar(pub_key, max_distance, limit)
+    return [{'key': key, 'distance': distance, 'matches': matches} for key, distance, matches in similar]
+
+def get_img_preview_indices(library=DEFAULT_LIBRARY):
+    pub_keys = get_gallery_db(library).cursor().execute('SELECT itemBibTexKey, previewImageIndex FROM gallery')
     indices = {}
     for key, index in pub_keys.fetchall():
         indices[key] = index
     return indices
 
 # Flask Routes
-@app.route('/api/incrementImageIndex/<string:itemBibTexKey>/<int:increase>', methods=['POST'])
-def increment_img_index(itemBibTexKey, increase):
+# Every route is served for the default library at / and for every other
+# library at /lib/<library_name>/
+def library_route(rule, **options):
+    def decorator(f):
+        app.route(rule, defaults={'library_name': DEFAULT_LIBRARY_NAME}, **options)(f)
+        app.route('/lib/<library_name>' + rule, **options)(f)
+        return f
+    return decorator
+
+def get_library(library_name):
+    library = LIBRARIES.get(library_name)
+    if library is None:
+        abort(404)
+    return library
+
+@library_route('/api/incrementImageIndex/<string:itemBibTexKey>/<int:increase>', methods=['POST'])
+def increment_img_index(library_name, itemBibTexKey, increase):
+    library = get_library(library_name)
     value = 1 if increase > 0 else -1
-    current_value = get_img_preview_indices()[itemBibTexKey]
-    max_value = len(get_publications()[itemBibTexKey]['images'])
+    current_value = get_img_preview_indices(library)[itemBibTexKey]
+    max_value = len(get_publications(library=library)[itemBibTexKey]['images'])
     new_index = max(0, min(current_value + value, max_value))
-    db = get_gallery_db()
-    db.cursor().execute(f'UPDATE gallery SET previewImageIndex = {new_index} WHERE itemBibTexKey = "{itemBibTexKey}"')
+    db = get_gallery_db(library)
+    db.cursor().execute('UPDATE gallery SET previewImageIndex = ? WHERE itemBibTexKey = ?', (new_index, itemBibTexKey))
     db.commit()
+    publication_cache.invalidate(library.name)
 
     out = f'Index for {itemBibTexKey} is now {new_index}'
     print(out)
     return out
 
-@app.route('/api/getPublications')
-def api_get_publications():
-    return get_publications()
-
-@app.route('/api/getAttachment/<path:filename>')
-def get_zotero_attachment(filename):
-    return send_from_directory(STORAGE_DIR, filename)
-
-@app.route('/')
-def index():
-    publications = get_publications()
-    preview_indices = get_img_preview_indices()
+@library_route('/api/getPublications')
+def api_get_publications(library_name):
+    return get_publications(request.args.get('collection'), get_library(library_name))
+
+@library_route('/api/getCollections')
+def api_get_collections(library_name):
+    return get_gallery_collections(get_library(library_name))
+
+@library_route('/api/similar/<string:itemBibTexKey>')
+def api_get_similar(library_name, itemBibTexKey):
+    library = get_library(library_name)
+    max_distance = min(request.args.get('distance', SIMILAR_IMAGE_MAX_DISTANCE, type=int), 64)
+    limit = request.args.get('limit', None, type=int)
+    return {'similar': get_similar_publications(itemBibTexKey, max_distance, limit, library)}
+
+@library_route('/api/getAttachment/<path:filename>')
+def get_zotero_attachment(library_name, filename):
+    return send_from_directory(get_library(library_name).storage_dir, filename)
+
+@app.route('/api/getLibraries')
+def api_get_libraries():
+    cache_stats = publication_cache.stats()
+    return {
+        name: {
+            'url': '/' if name == DEFAULT_LIBRARY_NAME else f'/lib/{name}/',
+            'cache': cache_stats.get(name, {'entries': 0, 'bytes': 0}),
+        }
+        for name in LIBRARIES
+    }
+
+# The default library's images are served from the static `images` folder
+@app.route('/lib/<library_name>/images/<path:filename>')
+def get_library_image(library_name, filename):
+    return send_from_directory(get_library(library_name).pubs_folder, filename)
+
+@library_route('/')
+def index(library_name):
+    library = get_library(library_name)
+    publications = get_publications(library=library)
+    preview_indices = get_img_preview_indices(library)
     return render_template('index.html', publications=publications, preview_indices=preview_indices)
 
-def remove_entry(entry_key):
-    out_folder = PUBS_FOLDER.joinpath(entry_key)
-    if os.path.exists(out_folder):
-        shutil.rmtree(out_folder)
-        print('removed folder', out_folder)
+def export_static(out_dir, jobs=None, library=DEFAULT_LIBRARY):
+    '''
+    Pre-render the gallery into a static site in `out_dir` (HTML, JSON shards
+    per page, tag and collection, and thumbnails) that any static file server
+    can host. Only files whose inputs changed since the last export are
+    rewritten.
+    '''
+    # only needed for exporting, so don't import it at startup
+    from static_export import export_site
 
+    print('Exporting...')
     with app.app_context():
-        con_gallery = get_gallery_db()
-        cur_gallery = con_gallery.cursor()
-        cur_gallery.execute(f'DELETE FROM gallery WHERE itemBibTexKey = "{entry_key}"')
-        con_gallery.commit()
-        print('removed entry', entry_key, 'from gallery database')
+        publications = get_publications(library=library)
+        collections = get_gallery_collections(library)
+        for collection_key, collection in collections.items():
+            collection['members'] = sorted(get_collection_members(collection_key, library))
+        index_html = render_template('index.html', static_export=True)
+    export_site(out_dir, index_html, publications, collections, library.pubs_folder, EXPORT_PAGE_SIZE, EXPORT_THUMBNAIL_WIDTH, jobs)
+    print(f'    - exported {len(publications)} publications to {out_dir}')
+
+def resolve_entry_keys(patterns=(), tag=None, library=DEFAULT_LIBRARY):
+    '''
+    Resolve bibtex keys and glob patterns (e.g. `smith*2005`) against the
+    gallery database, plus every gallery entry tagged with `tag` in Zotero.
+    '''
+    with app.app_context():
+        gallery_keys = [k for (k, ) in get_gallery_db(library).cursor().execute('SELECT itemBibTexKey FROM gallery').fetchall()]
+
+        keys = set()
+        for pattern in patterns:
+            if any(c in pattern for c in '*?['):
+                keys.update(fnmatch.filter(gallery_keys, pattern))
+            else:
+                keys.add(pattern)
+
+        if tag is not None:
+            cur_zotero = get_zotero_db(library).cursor()
+            tagged_ids = {item_id for (item_id, ) in cur_zotero.execute('''
+                SELECT itemTags.itemID FROM itemTags
+                    INNER JOIN tags ON tags.tagID = itemTags.tagID AND tags.name = ?
+            ''', (tag, )).fetchall()}
+            gallery_key_set = set(gallery_keys)
+            keys.update(e['citekey'] for e in get_bbt_json(library) if e['itemID'] in tagged_ids and e['citekey'] in gallery_key_set)
 
+    return sorted(keys)
+
+def remove_entries(entry_keys, library=DEFAULT_LIBRARY):
+    '''
+    Remove every bibtex key in `entry_keys` from the images gallery and the
+    gallery database (in a single transaction).
+    '''
+    for entry_key in entry_keys:
+        out_folder = library.pubs_folder.joinpath(entry_key)
+        if os.path.exists(out_folder):
+            shutil.rmtree(out_folder)
+            print('removed folder', out_folder)
+
+    with app.app_context():
+        con_gallery = get_gallery_db(library)
+        with con_gallery:
+            before = con_gallery.total_changes
+            con_gallery.executemany('DELETE FROM gallery WHERE itemBibTexKey = ?', [(k, ) for k in entry_keys])
+            removed = con_gallery.total_changes - before
+            try:
+                con_gallery.executemany('DELETE FROM galleryCollectionMembership WHERE itemBibTexKey = ?', [(k, ) for k in entry_keys])
+                con_gallery.executemany('DELETE FROM imageHashes WHERE itemBibTexKey = ?', [(k, ) for k in entry_keys])
+            except sqlite3.OperationalError:
+                pass
+        print('removed', removed, 'entries from gallery database')
+
+def remove_entry(entry_key, library=DEFAULT_LIBRARY):
+    remove_entries([entry_key], library)
+
+
+# Get all command line arguments following `flag`, up to the next --flag (None
+# if `flag` isn't given)
+def get_flag_values(flag):
+    if flag not in sys.argv:
+        return None
+    values = []
+    for arg in sys.argv[sys.argv.index(flag) + 1:]:
+        if arg.startswith('--'):
+            break
+        values.append(arg)
+    return values
+
+# Remove `flag` and the single value following it from the command line
+# arguments, and return that value (None if `flag` isn't given)
+def pop_flag_value(flag):
+    if flag not in sys.argv:
+        return None
+    flag_index = sys.argv.index(flag)
+    if flag_index + 1 >= len(sys.argv) or sys.argv[flag_index + 1].startswith('--'):
+        print_help()
+        exit(1)
+    value = sys.argv[flag_index + 1]
+    del sys.argv[flag_index:flag_index + 2]
+    return value
 
 def print_help():
     app_help = '''
@@ -510,14 +989,28 @@ usage: python3 ./app.py <options>
 
 options:
 run <debug>: run the gallery server (optionally in debug mode)
-extract:    extract images from any new publications in the Zotero database
+extract <--only key1 key2 ...> <--collections name1 name2 ...>: extract
+            images from any new publications in the gallery collections (and
+            their sub-collections) of the Zotero database. Optionally only the
+            given bibtex keys, or different collections than `_Gallery`.
 pull:       pull databases from Zotero and make a backup in case something goes wrong.
 push:       push databases to Zotero and make a backup in case something goes wrong.
 pack:       pack all images into a single zip file and get rid of all images
             that aren't the single one we're displaying on the gallery.
 unpack:     unpack gallery.zip file into the images folder
-remove <entry_key>: remove the bibtex entry key from the database and images gallery
-clean:      remove ALL extracted images, databases, etc. Does not modify Zotero sync.
+remove <entry_key ...> <--tag tag>: remove the bibtex entry keys (or glob
+            patterns like `smith*`, or every entry tagged with `tag`) from the
+            database and images gallery
+hash:       compute the perceptual hash of every extracted image that doesn't
+            have one yet (used to find publications with similar figures)
+export <dir> <--jobs n>: pre-render the gallery into a static site in <dir>,
+            using n processes to generate thumbnails (default: all CPUs)
+clean:      remove ALL extracted images, databases, etc. of the library. Does
+            not modify Zotero sync or other libraries.
+
+Every option except `run` accepts `--library <name>` to work on one of the
+libraries in data/libraries.json instead of the default library. `run` serves
+all of them (the default library at /, the others at /lib/<name>/).
 '''
     print(app_help)
 
@@ -526,50 +1019,83 @@ if __name__ == '__main__':
     # remove_entry('forsbergComparing3DVector2009')
     # exit(0)
 
+    # single-value flags, removed before reading each command's arguments
+    library_name = pop_flag_value('--library')
+    tag = pop_flag_value('--tag')
+    jobs = pop_flag_value('--jobs')
+
+    if library_name is not None and library_name not in LIBRARIES:
+        print('Library must be one of', ', '.join(LIBRARIES))
+        exit(1)
+    library = LIBRARIES[library_name] if library_name is not None else DEFAULT_LIBRARY
+
     if len(sys.argv) == 1:
         print_help()
         exit(1)
 
     elif 'pull' in sys.argv:
-        pull()
+        pull(library=library)
         exit(0)
 
     elif 'push' in sys.argv:
-        push()
+        push(library)
         exit(0)
 
     elif 'pack' in sys.argv:
-        pack()
+        pack(library)
         exit(0)
 
     elif 'unpack' in sys.argv:
-        unpack()
+        unpack(library)
         exit(0)
 
     elif 'extract' in sys.argv:
-        extract_images()
+        only_keys = get_flag_values('--only')
+        collection_names = get_flag_values('--collections')
+        if (only_keys is not None and len(only_keys) == 0) or (collection_names is not None and len(collection_names) == 0):
+            print_help()
+            exit(1)
+        extract_images(only_keys, collection_names, library)
         exit(0)
 
     elif 'remove' in sys.argv:
-        if len(sys.argv) == 3:
-            remove_entry(sys.argv[2])
+        args = get_flag_values('remove')
+        if len(args) > 0 or tag is not None:
+            remove_entries(resolve_entry_keys(args, tag, library), library)
             exit(0)
         else:
             print_help()
             exit(1)
 
+    elif 'hash' in sys.argv:
+        hash_gallery_images(library)
+        exit(0)
+
+    elif 'export' in sys.argv:
+        args = get_flag_values('export')
+        if len(args) != 1 or (jobs is not None and (not jobs.isdigit() or int(jobs) < 1)):
+            print_help()
+            exit(1)
+        export_static(Path(args[0]).resolve(), int(jobs) if jobs is not None else None, library)
+        exit(0)
+
     elif 'clean' in sys.argv:
-        folders_to_remove = [GALLERY_DATA_DIR, PUBS_FOLDER]
-        if input('Are you sure you want to remove the folders {}? (y/n): '.format(folders_to_remove)).lower() == 'y':
-            for folder in folders_to_remove:
-                shutil.rmtree(folder)
-                print('Removed folder', folder)
+        paths_to_remove = [p for p in library.clean_paths() if p.exists()]
+        if input('Are you sure you want to remove {}? (y/n): '.format([str(p) for p in paths_to_remove])).lower() == 'y':
+            for path in paths_to_remove:
+                if path.is_dir():
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+                print('Removed', path)
 
     elif 'run' in sys.argv:
         debug = 'debug' in sys.argv
         app.debug = debug
 
         if debug:
+            # only needed for debugging, so don't import it at startup
+            from livereload import Server
             server = Server(app.wsgi_app)
             server.application(FLASK_PORT, FLASK_HOST)
             server.serve()
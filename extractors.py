@@ -0,0 +1,74 @@
+# Registry of image extractors by attachment MIME type.
+#
+# Extractors are registered as 'module:function' strings and only imported the
+# first time an attachment of that type is extracted, so commands that never
+# extract anything (run, pull, push...) don't pay for importing PyMuPDF,
+# BeautifulSoup, etc.
+#
+# Third-party extractors can be added through the `zotero_gallery.extractors`
+# entry point group, with the MIME type as the entry point name, e.g. in a
+# plugin's pyproject.toml:
+#
+# [project.entry-points."zotero_gallery.extractors"]
+# "image/png" = "gallery_png:extract_png_images"
+#
+# Every extractor is called as `extractor(imgdir, fname)`.
+
+import importlib
+
+ENTRY_POINT_GROUP = 'zotero_gallery.extractors'
+
+# MIME type: 'module:function' string, entry point, or already imported function
+_extractors = {
+    'application/pdf': 'extract_pdf_images:extract_pdf_images',
+    'text/html': 'extract_html_images:extract_html_images',
+}
+_entry_points_loaded = False
+
+def register_extractor(content_type, extractor):
+    '''
+    Register an extractor for `content_type`, either a function or a
+    'module:function' string to import when it's first needed.
+    '''
+    _extractors[content_type] = extractor
+
+def get_extractor(content_type):
+    '''
+    Get the extractor function for `content_type` (importing it if needed), or
+    None if there isn't one.
+    '''
+    if content_type not in _extractors:
+        load_entry_points()
+    extractor = _extractors.get(content_type)
+    if extractor is None or callable(extractor):
+        return extractor
+
+    if isinstance(extractor, str):
+        module_name, _, function_name = extractor.partition(':')
+        extractor = getattr(importlib.import_module(module_name), function_name)
+    else:
+        extractor = extractor.load()
+    _extractors[content_type] = extractor
+    return extractor
+
+def load_entry_points():
+    '''
+    Find extractors installed by other packages (without importing them). Built
+    in and explicitly registered extractors take priority.
+    '''
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    _entry_points_loaded = True
+
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return
+    all_entry_points = entry_points()
+    if hasattr(all_entry_points, 'select'):
+        group = all_entry_points.select(group=ENTRY_POINT_GROUP)
+    else:
+        group = all_entry_points.get(ENTRY_POINT_GROUP, [])
+    for entry_point in group:
+        _extractors.setdefault(entry_point.name, entry_point)
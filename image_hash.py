@@ -0,0 +1,154 @@
+# Perceptual hashes of extracted images, used to find publications with
+# near-duplicate or visually similar figures.
+#
+# The hash is the DCT-based pHash: each image is scaled down to a 32x32
+# grayscale image, and the 8x8 lowest frequencies of its 2D DCT are compared to
+# their median, giving 64 bits. The DC term (average brightness) is much larger
+# than everything else, so its bit would always be set: the next horizontal
+# frequency is used in its place. Images are hashed in
+# batches with a single matrix product per batch.
+#
+# Hashes are stored as signed 64-bit integers (SQLite INTEGER), and similar
+# images are found by Hamming distance between hashes.
+
+import numpy as np
+
+HASH_SIZE = 8
+IMAGE_SIZE = 32
+HASH_BATCH_SIZE = 256
+
+def dct_matrix(n):
+    # orthonormal DCT-II basis, so the 2D DCT of X is D @ X @ D.T
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    d = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    d[0] /= np.sqrt(2)
+    return d
+
+# one extra frequency, to replace the DC term
+DCT = dct_matrix(IMAGE_SIZE)[:HASH_SIZE + 1]
+BIT_WEIGHTS = (np.uint64(1) << np.arange(HASH_SIZE * HASH_SIZE - 1, -1, -1, dtype=np.uint64))
+
+# number of set bits of every byte value
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def load_pixels(path):
+    '''
+    Load the image at `path` as a IMAGE_SIZE x IMAGE_SIZE grayscale float
+    array, or None if it can't be decoded (svg, gif...)
+    '''
+    # imported here so only hashing pays for PyMuPDF
+    import fitz
+    try:
+        pix = fitz.Pixmap(str(path))
+        if pix.colorspace is None or pix.colorspace.n != 1:
+            pix = fitz.Pixmap(fitz.csGRAY, pix)
+        pix = fitz.Pixmap(pix, IMAGE_SIZE, IMAGE_SIZE, None)
+    except Exception:
+        return None
+    samples = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)
+    return samples[:, :pix.width * pix.n:pix.n].astype(np.float64)
+
+def phash_pixels(pixels):
+    '''
+    Perceptual hashes (uint64) of a batch of images, shape (n, IMAGE_SIZE,
+    IMAGE_SIZE)
+    '''
+    # low frequencies of the 2D DCT of every image: (n, HASH_SIZE + 1, HASH_SIZE + 1)
+    freqs = np.einsum('ij,njk,lk->nil', DCT, pixels, DCT)
+    low_freqs = freqs[:, :HASH_SIZE, :HASH_SIZE].reshape(len(pixels), -1)
+    low_freqs[:, 0] = freqs[:, 0, HASH_SIZE]
+    medians = np.median(low_freqs, axis=1, keepdims=True)
+    bits = low_freqs > medians
+    return (bits.astype(np.uint64) * BIT_WEIGHTS).sum(axis=1, dtype=np.uint64)
+
+def hash_images(paths):
+    '''
+    Perceptual hash of every image in `paths` as a signed 64-bit int (to be
+    stored in SQLite), or None for images that can't be decoded
+    '''
+    hashes = [None] * len(paths)
+    for start in range(0, len(paths), HASH_BATCH_SIZE):
+        batch = [(i, load_pixels(paths[i])) for i in range(start, min(start + HASH_BATCH_SIZE, len(paths)))]
+        batch = [(i, pixels) for i, pixels in batch if pixels is not None]
+        if len(batch) == 0:
+            continue
+        batch_hashes = phash_pixels(np.stack([pixels for _i, pixels in batch])).view(np.int64)
+        for (i, _pixels), h in zip(batch, batch_hashes):
+            hashes[i] = int(h)
+    return hashes
+
+def hamming_distances(hashes, query):
+    '''
+    Hamming distance between `query` and every hash in `hashes` (uint64 array)
+    '''
+    xor = np.bitwise_xor(hashes, np.uint64(query))
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(xor)
+    return POPCOUNT_TABLE[xor.view(np.uint8)].reshape(len(xor), 8).sum(axis=1, dtype=np.uint8)
+
+class ImageHashIndex:
+    '''
+    Bit-packed index of the perceptual hashes of every image in the gallery:
+    one uint64 per image and the index of the publication it belongs to.
+    Queries are a vectorized Hamming distance scan over all hashes.
+    '''
+    def __init__(self, rows):
+        # rows: (bibtex key, hash as signed 64-bit int)
+        self.keys = sorted({key for key, _hash in rows})
+        key_index = {key: i for i, key in enumerate(self.keys)}
+        self.hashes = np.array([h for _key, h in rows], dtype=np.int64).view(np.uint64)
+        self.owners = np.array([key_index[key] for key, _hash in rows], dtype=np.int32)
+        self._key_index = key_index
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def query(self, query_hash, radius):
+        '''
+        Indices of every image within Hamming distance `radius` of
+        `query_hash`, and their distances
+        '''
+        distances = hamming_distances(self.hashes, np.int64(query_hash).view(np.uint64))
+        matches = np.flatnonzero(distances <= radius)
+        return matches, distances[matches]
+
+    def similar(self, pub_key, radius, limit=None):
+        '''
+        Publications with at least one image within Hamming distance `radius`
+        of one of `pub_key`'s images, closest first: a list of
+        (bibtex key, smallest distance, number of `pub_key`'s images matched)
+        '''
+        pub_index = self._key_index.get(pub_key)
+        if pub_index is None:
+            return []
+        # every match of every one of `pub_key`'s images, grouped by owner once
+        all_owners = []
+        all_distances = []
+        all_queries = []
+        query_hashes = self.hashes[self.owners == pub_index]
+        for query_index, query_hash in enumerate(query_hashes):
+            matches, distances = self.query(query_hash.view(np.int64), radius)
+            all_owners.append(self.owners[matches])
+            all_distances.append(distances)
+            all_queries.append(np.full(len(matches), query_index))
+        owners = np.concatenate(all_owners)
+        others = owners != pub_index
+        owners = owners[others]
+        distances = np.concatenate(all_distances)[others]
+        queries = np.concatenate(all_queries)[others]
+        if len(owners) == 0:
+            return []
+
+        result_owners, owner_groups = np.unique(owners, return_inverse=True)
+        best = np.full(len(result_owners), np.iinfo(np.int64).max)
+        np.minimum.at(best, owner_groups, distances.astype(np.int64))
+        # number of distinct query images matching each owner
+        pairs = np.unique(owner_groups.astype(np.int64) * len(query_hashes) + queries)
+        matched = np.bincount(pairs // len(query_hashes), minlength=len(result_owners))
+
+        # keys are sorted, so owner indices sort like keys
+        order = np.lexsort((result_owners, -matched, best))
+        if limit is not None:
+            order = order[:limit]
+        return [(self.keys[result_owners[i]], int(best[i]), int(matched[i])) for i in order]
@@ -24,10 +24,9 @@ except sqlite3.OperationalError:
     pass
 output_cur.execute('CREATE TABLE gallery (itemBibTexKey TEXT PRIMARY KEY NOT NULL, previewImageIndex INT DEFAULT 0);')
 
-# select all existing entries from table
-gallery_result = input_cur.execute(f'SELECT itemKey, previewImageIndex, zoteroItemID FROM gallery')
-for bibtex_key, preview_image_index, item_id in gallery_result.fetchall():
-    # migrate them one at a time
-    output_cur.execute(f'INSERT INTO gallery (itemBibTexKey, previewImageIndex) VALUES ("{bibtex_key}", {preview_image_index});')
-    print('Migrated', bibtex_key, preview_image_index)
-output_db.commit() 
+# select all existing entries from table and stream them into the output
+# table in a single transaction
+gallery_result = input_cur.execute('SELECT itemKey, previewImageIndex FROM gallery')
+with output_db:
+    output_cur.executemany('INSERT INTO gallery (itemBibTexKey, previewImageIndex) VALUES (?, ?);', gallery_result)
+print('Migrated', output_cur.rowcount, 'entries')
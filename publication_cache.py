@@ -0,0 +1,69 @@
+import json
+import threading
+from collections import OrderedDict
+
+class PublicationCache:
+    '''
+    In-memory cache of publication listings for every library served by the
+    gallery.
+
+    Each library has its own entries (one per collection filter), but all of
+    them share a single memory budget: when the cache grows past `max_bytes`,
+    the least recently used entries are evicted first, whichever library they
+    belong to.
+
+    Every entry is stored with a `version` (e.g. modification times of the
+    databases it was built from), and is discarded on lookup if the version
+    doesn't match anymore.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # (library name, key): (version, value, size in bytes)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, library_name, key, version):
+        with self._lock:
+            entry = self._entries.get((library_name, key))
+            if entry is None:
+                return None
+            if entry[0] != version:
+                self._remove((library_name, key))
+                return None
+            self._entries.move_to_end((library_name, key))
+            return entry[1]
+
+    def put(self, library_name, key, version, value):
+        # approximate memory usage by the size of the serialized listing
+        size = len(json.dumps(value))
+        with self._lock:
+            self._remove((library_name, key))
+            if size > self.max_bytes:
+                return
+            self._entries[(library_name, key)] = (version, value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, library_name):
+        with self._lock:
+            for entry_key in [k for k in self._entries if k[0] == library_name]:
+                self._remove(entry_key)
+
+    def stats(self):
+        '''
+        Number of entries and bytes used by each library
+        '''
+        with self._lock:
+            stats = {}
+            for (library_name, _key), (_version, _value, size) in self._entries.items():
+                library_stats = stats.setdefault(library_name, {'entries': 0, 'bytes': 0})
+                library_stats['entries'] += 1
+                library_stats['bytes'] += size
+            return stats
+
+    def _remove(self, entry_key):
+        entry = self._entries.pop(entry_key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
@@ -0,0 +1,197 @@
+# Export the gallery as a static site (HTML, sharded JSON and thumbnails) that
+# can be hosted by any static file server.
+#
+# Publications are written in pages sorted by bibtex key, and every tag and
+# collection has a shard with the bibtex keys of its publications. The client
+# resolves tag and collection filters from those shards and only loads the
+# pages with the publications it's showing, one page at a time.
+#
+# The export is incremental: every output file is recorded in
+# .export_state.json along with a signature of its inputs, and is only
+# rewritten when that signature changes. Files that aren't part of the export
+# anymore are removed.
+
+import os
+import re
+import json
+import shutil
+import hashlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+STATE_FILE = '.export_state.json'
+DATA_DIR = 'data'
+THUMBS_DIR = 'thumbs'
+IMAGES_DIR = 'images'
+
+# Image types PyMuPDF can load to make thumbnails; others (svg, gif...) are
+# copied as-is
+THUMBNAIL_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.pnm', '.pam'}
+
+def make_thumbnail(src, dst, width):
+    '''
+    Shrink the image at `src` by powers of two until it's at most twice
+    `width` wide, and save it as PNG at `dst`.
+    '''
+    # imported here so only the export worker processes pay for PyMuPDF
+    import fitz
+    try:
+        pix = fitz.Pixmap(str(src))
+        shrink = 0
+        while pix.width >> (shrink + 1) >= width and shrink < 8:
+            shrink += 1
+        if shrink > 0:
+            pix.shrink(shrink)
+        # PNG can't store CMYK
+        if pix.colorspace is not None and pix.colorspace.n > 3:
+            pix = fitz.Pixmap(fitz.csRGB, pix)
+        pix.save(str(dst))
+    except Exception as e:
+        print('Warning: unable to make thumbnail for', src, '(' + str(e) + '), copying instead')
+        shutil.copyfile(src, dst)
+
+def copy_file(src, dst):
+    shutil.copyfile(src, dst)
+
+def file_signature(path, *extra):
+    stat = os.stat(path)
+    return [str(path), stat.st_mtime_ns, stat.st_size, *extra]
+
+def shard_name(name):
+    # file-system safe, and unique even if two names only differ in punctuation
+    slug = re.sub(r'[^A-Za-z0-9_-]+', '_', name)[:48]
+    return slug + '-' + hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]
+
+def export_site(out_dir, index_html, publications, collections, pubs_folder, page_size=100, thumbnail_width=400, jobs=None):
+    '''
+    Write the static gallery to `out_dir`.
+
+    - `index_html`: the rendered gallery page
+    - `publications`: bibtex key: publication data, as returned by `get_publications()`
+    - `collections`: collection key: {name, parent, members: list of bibtex keys}
+    - `pubs_folder`: folder with the extracted images of every publication
+    '''
+    out_dir = Path(out_dir)
+    pubs_folder = Path(pubs_folder)
+    state_path = out_dir.joinpath(STATE_FILE)
+    old_state = {}
+    if state_path.exists():
+        with open(state_path) as fin:
+            old_state = json.load(fin)
+    new_state = {}
+    written = 0
+
+    def is_current(rel_path, signature):
+        new_state[rel_path] = signature
+        return old_state.get(rel_path) == signature and out_dir.joinpath(rel_path).exists()
+
+    def write_file(rel_path, data):
+        nonlocal written
+        signature = hashlib.sha1(data).hexdigest()
+        if is_current(rel_path, signature):
+            return
+        path = out_dir.joinpath(rel_path)
+        os.makedirs(path.parent, exist_ok=True)
+        with open(path, 'wb') as fout:
+            fout.write(data)
+        written += 1
+
+    def write_json(rel_path, value):
+        write_file(rel_path, json.dumps(value, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+
+    # gather the preview image of every publication, and the images/thumbnails
+    # that need to be (re)generated
+    file_jobs = []
+    static_pubs = {}
+    for pub_key in sorted(publications):
+        pub_data = publications[pub_key]
+        if len(pub_data['images']) == 0:
+            print('Warning: publication', pub_key, 'has no images, skipping')
+            continue
+        img_index = min(max(0, pub_data['previewImageIndex']), len(pub_data['images']) - 1)
+        img_name = Path(pub_data['images'][img_index]).name
+        src = pubs_folder.joinpath(pub_key, img_name)
+
+        image_path = f'{IMAGES_DIR}/{pub_key}/{img_name}'
+        if not is_current(image_path, file_signature(src)):
+            file_jobs.append((copy_file, src, out_dir.joinpath(image_path)))
+
+        thumb_ext = '.png' if src.suffix.lower() in THUMBNAIL_EXTENSIONS else src.suffix
+        thumb_path = f'{THUMBS_DIR}/{pub_key}{thumb_ext}'
+        if not is_current(thumb_path, file_signature(src, thumbnail_width)):
+            if thumb_ext == '.png':
+                file_jobs.append((make_thumbnail, src, out_dir.joinpath(thumb_path), thumbnail_width))
+            else:
+                file_jobs.append((copy_file, src, out_dir.joinpath(thumb_path)))
+
+        # packed (-1) preview index hides the arrows to switch image, since
+        # there's only the preview image in the static gallery
+        static_pubs[pub_key] = {
+            'images': [thumb_path],
+            'previewImageIndex': -1,
+            'fileLink': image_path,
+            'tags': pub_data['tags'],
+            'info': pub_data['info'],
+        }
+
+    # generate images and thumbnails in parallel while writing the JSON shards
+    for folder in {Path(job[2]).parent for job in file_jobs}:
+        os.makedirs(folder, exist_ok=True)
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = [executor.submit(*job) for job in file_jobs]
+
+        # pages are sorted by bibtex key, so the client can find the page of
+        # any publication from the first key of every page
+        pub_keys = list(static_pubs)
+        pages = []
+        for page, start in enumerate(range(0, len(pub_keys), page_size)):
+            page_path = f'{DATA_DIR}/pages/page-{page + 1:05}.json'
+            write_json(page_path, {key: static_pubs[key] for key in pub_keys[start:start + page_size]})
+            pages.append({'file': page_path, 'first': pub_keys[start]})
+
+        tag_members = {}
+        for pub_key, pub_data in static_pubs.items():
+            for tag in pub_data['tags']:
+                tag_members.setdefault(tag, []).append(pub_key)
+        tags = {}
+        for tag, members in tag_members.items():
+            tag_path = f'{DATA_DIR}/tags/{shard_name(tag)}.json'
+            write_json(tag_path, members)
+            tags[tag] = {'count': len(members), 'file': tag_path}
+
+        static_collections = {}
+        for collection_key, collection in collections.items():
+            collection_path = f'{DATA_DIR}/collections/{shard_name(collection_key)}.json'
+            members = sorted(k for k in collection['members'] if k in static_pubs)
+            write_json(collection_path, members)
+            static_collections[collection_key] = {
+                'name': collection['name'],
+                'parent': collection['parent'],
+                'count': len(members),
+                'file': collection_path,
+            }
+
+        write_json(f'{DATA_DIR}/index.json', {
+            'publicationCount': len(static_pubs),
+            'pageSize': page_size,
+            'pages': pages,
+            'tags': tags,
+            'collections': static_collections,
+        })
+        write_file('index.html', index_html.encode('utf-8'))
+
+        for future in futures:
+            future.result()
+    written += len(file_jobs)
+
+    # get rid of anything that was exported before but isn't anymore
+    removed = 0
+    for rel_path in old_state.keys() - new_state.keys():
+        path = out_dir.joinpath(rel_path)
+        if path.exists():
+            os.unlink(path)
+            removed += 1
+
+    with open(state_path, 'w') as fout:
+        json.dump(new_state, fout)
+    print(f'    - wrote {written} files ({len(new_state) - written} unchanged, {removed} removed)')